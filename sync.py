@@ -1,51 +1,265 @@
 import os
 import io
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from googleapiclient.discovery import build
 from google.oauth2.service_account import Credentials
 from googleapiclient.http import MediaIoBaseDownload
 from googleapiclient.errors import HttpError
+from googleapiclient.model import JsonModel
 import time
 import json
+import sqlite3
 import tempfile
 import re
+import itertools
+import mmap
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# Try different PyPDF2 import methods for compatibility
+# Try PyMuPDF import (newer releases expose "pymupdf", older ones only "fitz")
 try:
-    from PyPDF2 import PdfReader, PdfWriter
-    print("Using PyPDF2 v3+ imports")
+    import pymupdf as fitz
+    print("PyMuPDF imported successfully")
 except ImportError:
     try:
-        from PyPDF2 import PdfFileReader as PdfReader, PdfFileWriter as PdfWriter
-        print("Using PyPDF2 v1-2 imports")
+        import fitz
+        print("PyMuPDF imported successfully (fitz)")
     except ImportError:
-        print("Warning: No PDF library available, PDF splitting will be disabled")
-        PdfReader = None
-        PdfWriter = None
+        print("Warning: PyMuPDF not available, PDF splitting will be disabled")
+        fitz = None
 
 # Try docx import
 try:
     from docx import Document
+    from docx.oxml.ns import qn
     print("python-docx imported successfully")
 except ImportError:
     print("Warning: python-docx not available, DOCX splitting will be disabled")
     Document = None
 
+# Try orjson import (faster parsing of Drive listings and Voiceflow responses)
+try:
+    import orjson
+    print("orjson imported successfully")
+except ImportError:
+    print("Warning: orjson not available, falling back to the standard json module")
+    orjson = None
+
 print("Starting Google Drive to Voiceflow sync script...")
 
+# 8 MiB: fewer ranged requests per download than the 1 MiB default, and the in-memory limit for spooled downloads
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Drive changes page token, kept between runs for incremental syncs
+SYNC_STATE_FILE = '.sync_state.json'
+
+# SQLite cache of (modifiedTime, md5Checksum) for every uploaded file, used to skip unchanged files
+SYNC_CACHE_FILE = '.sync_cache.db'
+
+_SANITIZE_RE = re.compile(r'[^\w\s\-_]+')
+
+# Google Workspace files are exported to the matching Office format
+_EXPORT_MAP = {
+    'application/vnd.google-apps.document': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.google-apps.presentation': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    'application/vnd.google-apps.spreadsheet': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+}
+
+_EXTENSION_MAP = {
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': '.docx',
+    'application/pdf': '.pdf',
+    'text/plain': '.txt'
+}
+
+# PDFs and Word documents larger than this are split into several Voiceflow documents
+SPLIT_THRESHOLD_BYTES = 10 * 1024 * 1024
+
+# Number of pages in each part when a PDF is split
+PAGES_PER_CHUNK = 5
+
+# Words in each part when a Word document is split (roughly 1000 tokens)
+DOCX_WORDS_PER_CHUNK = 750
+
+DOCX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+_json_loads = orjson.loads if orjson else json.loads
+
+
+class OrjsonModel(JsonModel):
+    """googleapiclient JSON model that parses responses with orjson."""
+    
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except ValueError:
+            # Not JSON: let the stock model handle it
+            return super().deserialize(content)
+        if self._data_wrapper and isinstance(body, dict) and 'data' in body:
+            body = body['data']
+        return body
+
+
+# Read size when streaming a download from the pipe into the upload body
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# How many times an upload is retried after Voiceflow answers 429 Too Many Requests
+MAX_RATE_LIMIT_RETRIES = 5
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing bursts of up to `capacity` calls, refilled at `rate` calls per second."""
+    
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError(f"Rate must be greater than 0 calls per second, got {rate}")
+        self.rate = rate
+        # A bucket that cannot hold a whole token would never let a call through
+        self.capacity = max(capacity or rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.updated:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    # Paused after a 429
+                    wait = self.updated - now
+            time.sleep(wait)
+    
+    def pause(self, seconds):
+        # Empty the bucket and hold refills back, so every worker backs off, not just the one that was throttled
+        with self.lock:
+            self.tokens = 0
+            self.updated = max(self.updated, time.monotonic() + seconds)
+
+
+# Percent-encode control characters and quotes in multipart header values, as urllib3 does for files=
+_MULTIPART_HEADER_ESCAPES = {c: f'%{c:02X}' for c in [*range(0x20), 0x7F, ord('"')]}
+
+
+def _multipart_framing(boundary, filename, mime_type):
+    """Return the bytes that go before and after the file data in a single-file multipart/form-data body."""
+    filename = filename.translate(_MULTIPART_HEADER_ESCAPES)
+    head = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f'Content-Type: {mime_type}\r\n\r\n'
+    ).encode()
+    return head, f'\r\n--{boundary}--\r\n'.encode()
+
+
+class MultipartFileBody:
+    """Seekable multipart/form-data body that reads the file on demand.
+    
+    requests' files= argument reads the whole file into one bytes body. This sends it with a Content-Length
+    instead, and tell/seek let urllib3 rewind it when a request is retried.
+    """
+    
+    def __init__(self, fileobj, filename, mime_type):
+        boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self._head, self._tail = _multipart_framing(boundary, filename, mime_type)
+        fileobj.seek(0, os.SEEK_END)
+        self._file_size = fileobj.tell()
+        self._file = fileobj
+        self._pos = 0
+    
+    def __len__(self):
+        return len(self._head) + self._file_size + len(self._tail)
+    
+    def tell(self):
+        return self._pos
+    
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence != os.SEEK_SET:
+            raise io.UnsupportedOperation("only absolute seeks are supported")
+        self._pos = offset
+        return self._pos
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self) - self._pos
+        file_end = len(self._head) + self._file_size
+        chunks = []
+        while size > 0 and self._pos < len(self):
+            if self._pos < len(self._head):
+                chunk = self._head[self._pos:self._pos + size]
+            elif self._pos < file_end:
+                self._file.seek(self._pos - len(self._head))
+                chunk = self._file.read(min(size, file_end - self._pos))
+                if not chunk:
+                    raise IOError("file is shorter than when the upload started")
+            else:
+                offset = self._pos - file_end
+                chunk = self._tail[offset:offset + size]
+            chunks.append(chunk)
+            self._pos += len(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+
 class GoogleDriveVoiceflowSync:
     def __init__(self, service_account_file, voiceflow_api_key, drive_folder_id):
         print("Initializing GoogleDriveVoiceflowSync...")
         
         self.SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
         self.credentials = Credentials.from_service_account_file(service_account_file, scopes=self.SCOPES)
-        self.drive_service = build('drive', 'v3', credentials=self.credentials)
+        # httplib2 (used by googleapiclient) is not thread-safe, so each worker thread gets its own Drive client
+        self._local = threading.local()
         
         self.voiceflow_api_key = voiceflow_api_key
         self.drive_folder_id = drive_folder_id
         self.voiceflow_base_url = "https://api.voiceflow.com"
         
-        self.supported_types = [
+        # Files are processed concurrently; uploads are capped separately so we stay within Voiceflow's quota
+        self.max_workers = int(os.getenv('SYNC_CONCURRENCY', '8'))
+        self.upload_slots = threading.BoundedSemaphore(int(os.getenv('VOICEFLOW_MAX_INFLIGHT', '4')))
+        self.upload_limiter = TokenBucket(float(os.getenv('VOICEFLOW_UPLOAD_RATE', '8')))
+        
+        # Only touched from the main thread in sync_documents, never from the workers
+        self.cache = sqlite3.connect(SYNC_CACHE_FILE)
+        self.cache.execute(
+            "CREATE TABLE IF NOT EXISTS uploaded ("
+            "file_id TEXT PRIMARY KEY, modifiedTime TEXT, md5 TEXT, voiceflow_doc_id TEXT)"
+        )
+        # Files that failed to sync, with their Drive metadata as JSON, so the next run retries them
+        self.cache.execute("CREATE TABLE IF NOT EXISTS failed (file_id TEXT PRIMARY KEY, file TEXT)")
+        
+        # One pooled session for all uploads so TCP/TLS connections are reused instead of handshaking per file
+        self.session = requests.Session()
+        retries = Retry(
+            total=5,
+            backoff_factor=0.5,
+            # 429 is handled in upload_to_voiceflow so the back-off applies to all workers. urllib3 would otherwise
+            # still retry any 429 carrying Retry-After itself, so it must not act on that header.
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=["POST"],
+            respect_retry_after_header=False
+        )
+        self.session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retries))
+        # requests already asks for gzip (and br when brotli is installed) and decodes it transparently
+        self.session.headers['User-Agent'] = 'drive-voiceflow-sync/1.0'
+        
+        # Opt-in: pipe Drive downloads straight into the upload body so downloading and uploading overlap.
+        # A streamed body cannot be replayed, so these uploads use a session without retries.
+        self.stream_uploads = os.getenv('SYNC_STREAM_UPLOADS') == '1'
+        self.stream_session = requests.Session()
+        self.stream_session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+        self.stream_session.headers['User-Agent'] = self.session.headers['User-Agent']
+        
+        self.supported_types = frozenset([
             'application/pdf',
             'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
             'application/msword',
@@ -58,87 +272,175 @@ class GoogleDriveVoiceflowSync:
             'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
             'application/vnd.ms-excel',
             'text/csv'
-        ]
+        ])
+        
+        # mimeType -> function building the Drive download request; None is the default for regular files
+        self._download_requests = {
+            mime_type: (lambda files, file_id, export_mime_type=export_mime_type:
+                        files.export_media(fileId=file_id, mimeType=export_mime_type))
+            for mime_type, export_mime_type in _EXPORT_MAP.items()
+        }
+        self._download_requests[None] = lambda files, file_id: files.get_media(fileId=file_id)
         
         print("Initialization complete!")
     
-    def get_drive_files(self):
+    @property
+    def drive_service(self):
+        service = getattr(self._local, 'drive_service', None)
+        if service is None:
+            service = build('drive', 'v3', credentials=self.credentials, cache_discovery=False,
+                            model=OrjsonModel() if orjson else None)
+            self._local.drive_service = service
+        return service
+    
+    @property
+    def drive_files(self):
+        # files() builds a new Resource on every call, so keep one per thread
+        files = getattr(self._local, 'drive_files', None)
+        if files is None:
+            files = self.drive_service.files()
+            self._local.drive_files = files
+        return files
+    
+    def iter_drive_files(self):
+        """Yield supported files in the folder page by page, so syncing can start before the listing finishes."""
         print("Fetching files from Google Drive...")
-        try:
-            # Get all files from the specific folder
-            query = f"'{self.drive_folder_id}' in parents and trashed=false"
+        # Get supported files from the specific folder, filtering by type on the server
+        mime_filter = " or ".join(f"mimeType='{m}'" for m in sorted(self.supported_types))
+        query = f"'{self.drive_folder_id}' in parents and trashed=false and ({mime_filter})"
+        
+        page_token = None
+        page_count = 0
+        total = 0
+        
+        while True:
+            page_count += 1
+            results = self.drive_files.list(
+                q=query,
+                fields="nextPageToken, files(id, name, mimeType, modifiedTime, md5Checksum, size)",
+                pageSize=1000,
+                pageToken=page_token
+            ).execute()
             
-            all_files = []
-            page_token = None
+            files = results.get('files', [])
+            total += len(files)
+            print(f"Page {page_count}: Found {len(files)} files (Total so far: {total})")
+            yield from files
+            
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+    
+    def get_start_page_token(self):
+        try:
+            return self.drive_service.changes().getStartPageToken().execute()['startPageToken']
+        except Exception as e:
+            print(f"Error fetching Drive start page token: {e}")
+            return None
+    
+    def iter_files_to_sync(self, page_token):
+        """Yield files changed since page_token, or every file in the folder when there is no usable token.
+        
+        The page token to persist after this run is left in self.new_page_token, and the ids of files that were
+        removed, trashed or moved out of the folder are collected in self.gone_ids.
+        """
+        if page_token:
+            print("Fetching changes from Google Drive...")
+            # A file changed several times since the last run is only synced once
+            seen = set()
             page_count = 0
             
             while True:
                 page_count += 1
-                results = self.drive_service.files().list(
-                    q=query,
-                    fields="nextPageToken, files(id, name, mimeType, modifiedTime)",
-                    pageSize=100,
-                    pageToken=page_token
-                ).execute()
-                
-                files = results.get('files', [])
-                all_files.extend(files)
+                try:
+                    results = self.drive_service.changes().list(
+                        pageToken=page_token,
+                        fields="nextPageToken, newStartPageToken, changes(fileId, removed, file(id, name, mimeType, modifiedTime, md5Checksum, size, parents, trashed))",
+                        pageSize=1000
+                    ).execute()
+                except Exception as e:
+                    if page_count > 1:
+                        raise
+                    # Usually an expired or invalid token
+                    print(f"Error fetching Drive changes: {e}")
+                    print("Falling back to a full folder scan.")
+                    self.full_scan = True
+                    break
                 
-                print(f"Page {page_count}: Found {len(files)} files (Total so far: {len(all_files)})")
+                changes = results.get('changes', [])
+                print(f"Page {page_count}: Found {len(changes)} changes")
+                for change in changes:
+                    file = change.get('file')
+                    file_id = change.get('fileId') or (file or {}).get('id')
+                    if file_id in seen:
+                        continue
+                    if (change.get('removed') or not file or file.get('trashed')
+                            or self.drive_folder_id not in file.get('parents', [])
+                            or file['mimeType'] not in self.supported_types):
+                        self.gone_ids.add(file_id)
+                        continue
+                    seen.add(file_id)
+                    self.gone_ids.discard(file_id)
+                    yield file
                 
-                page_token = results.get('nextPageToken')
-                if not page_token:
-                    break
-            
-            # Filter for supported file types
-            supported_files = [f for f in all_files if f['mimeType'] in self.supported_types]
-            print(f"Total files: {len(all_files)}, Supported files: {len(supported_files)}")
-            
-            return supported_files
-            
-        except Exception as e:
-            print(f"Error fetching Drive files: {e}")
-            return []
+                if 'newStartPageToken' in results:
+                    self.new_page_token = results['newStartPageToken']
+                    return
+                page_token = results['nextPageToken']
+        
+        # Take the token before listing so changes made during this run are picked up next time
+        self.full_scan = True
+        self.new_page_token = self.get_start_page_token()
+        yield from self.iter_drive_files()
     
-    def download_file(self, file_id, file_name):
-        print(f"  Downloading: {file_name}")
+    def load_state(self):
         try:
-            file_info = self.drive_service.files().get(fileId=file_id, fields='mimeType').execute()
-            original_mime_type = file_info['mimeType']
-            
-            export_map = {
-                'application/vnd.google-apps.document': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-                'application/vnd.google-apps.presentation': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
-                'application/vnd.google-apps.spreadsheet': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-            }
-            
-            if original_mime_type in export_map:
-                upload_mime_type = export_map[original_mime_type]
-                request = self.drive_service.files().export_media(fileId=file_id, mimeType=upload_mime_type)
-            else:
-                upload_mime_type = original_mime_type
-                request = self.drive_service.files().get_media(fileId=file_id)
-            
-            file_content_io = io.BytesIO()
-            downloader = MediaIoBaseDownload(file_content_io, request)
-            
+            with open(SYNC_STATE_FILE) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print(f"Warning: could not read {SYNC_STATE_FILE}, running a full sync: {e}")
+            return {}
+    
+    def save_state(self, state):
+        tmp_path = SYNC_STATE_FILE + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, SYNC_STATE_FILE)
+        except OSError as e:
+            print(f"Warning: could not write {SYNC_STATE_FILE}: {e}")
+    
+    def _download_to_buffer(self, request):
+        # Small files stay in memory, larger ones spill to disk instead of being held in RAM
+        buf = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_CHUNK_SIZE)
+        try:
+            downloader = MediaIoBaseDownload(buf, request, chunksize=DOWNLOAD_CHUNK_SIZE)
             done = False
             while not done:
                 status, done = downloader.next_chunk()
+        except Exception:
+            buf.close()
+            raise
+        buf.seek(0)
+        return buf
+    
+    def download_file(self, file_id, file_name, original_mime_type):
+        print(f"  Downloading: {file_name}")
+        try:
+            build_request = self._download_requests.get(original_mime_type, self._download_requests[None])
+            request = build_request(self.drive_files, file_id)
+            upload_mime_type = _EXPORT_MAP.get(original_mime_type, original_mime_type)
             
-            return file_content_io.getvalue(), upload_mime_type
+            return self._download_to_buffer(request), upload_mime_type
 
         except HttpError as error:
             if error.resp.status == 403 and 'exportSizeLimitExceeded' in error.content.decode():
                 print(f"  Export failed due to size limit. Retrying as plain text.")
                 try:
-                    text_request = self.drive_service.files().export_media(fileId=file_id, mimeType='text/plain')
-                    text_content_io = io.BytesIO()
-                    text_downloader = MediaIoBaseDownload(text_content_io, text_request)
-                    done = False
-                    while not done:
-                        status, done = text_downloader.next_chunk()
-                    return text_content_io.getvalue(), 'text/plain'
+                    text_request = self.drive_files.export_media(fileId=file_id, mimeType='text/plain')
+                    return self._download_to_buffer(text_request), 'text/plain'
                 except Exception as text_e:
                     print(f"  Fallback to plain text also failed: {text_e}")
                     return None, None
@@ -149,79 +451,395 @@ class GoogleDriveVoiceflowSync:
             print(f"  An unexpected error occurred: {e}")
             return None, None
     
+    def split_pdf(self, pdf_file):
+        """Yield (first_page, last_page, pdf_bytes) for consecutive PAGES_PER_CHUNK page ranges, 1-based."""
+        # Move the download to disk and map it, so pages are read on demand rather than from a copy on the Python heap
+        pdf_file.rollover()
+        with mmap.mmap(pdf_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            doc = None
+            try:
+                try:
+                    doc = fitz.open(stream=view, filetype="pdf")
+                except TypeError:
+                    # Older PyMuPDF releases only accept bytes
+                    doc = fitz.open(stream=mapped[:], filetype="pdf")
+                for start in range(0, doc.page_count, PAGES_PER_CHUNK):
+                    end = min(start + PAGES_PER_CHUNK, doc.page_count) - 1
+                    part = fitz.open()
+                    try:
+                        part.insert_pdf(doc, from_page=start, to_page=end)
+                        yield start + 1, end + 1, part.tobytes()
+                    finally:
+                        part.close()
+            finally:
+                if doc is not None:
+                    doc.close()
+                # The mapping cannot be closed while the document still holds an export of it
+                del doc
+                view.release()
+    
+    def split_docx(self, docx_file):
+        """Yield (part_number, docx_bytes) with about DOCX_WORDS_PER_CHUNK words of paragraph text each.
+        
+        Yields nothing for documents with tables, images or other non-paragraph content, which the parts would lose.
+        """
+        doc = Document(docx_file)
+        body = doc.element.body
+        allowed_tags = {qn('w:p'), qn('w:sectPr')}
+        if any(child.tag not in allowed_tags for child in body.iterchildren()) or \
+                body.xpath('.//w:drawing | .//w:pict | .//w:object'):
+            return
+        
+        paragraphs = []
+        word_count = 0
+        part_number = 0
+        for paragraph in doc.paragraphs:
+            paragraphs.append((paragraph.text, paragraph.style.name if paragraph.style is not None else None))
+            word_count += len(paragraph.text.split())
+            if word_count >= DOCX_WORDS_PER_CHUNK:
+                part_number += 1
+                yield part_number, self._build_docx(paragraphs)
+                paragraphs = []
+                word_count = 0
+        if word_count:
+            yield part_number + 1, self._build_docx(paragraphs)
+    
+    def _build_docx(self, paragraphs):
+        part = Document()
+        for text, style in paragraphs:
+            try:
+                # Keeps headings and lists; styles missing from the default template fall back to Normal
+                part.add_paragraph(text, style=style)
+            except KeyError:
+                part.add_paragraph(text)
+        out = io.BytesIO()
+        part.save(out)
+        return out.getvalue()
+    
+    def _maybe_chunk(self, file_content, mime_type, file_name):
+        """Yield (content, mime_type, file_name) for each document to upload, splitting oversized PDFs and DOCX files."""
+        file_content.seek(0, os.SEEK_END)
+        size = file_content.tell()
+        file_content.seek(0)
+        
+        if size > SPLIT_THRESHOLD_BYTES and mime_type == 'application/pdf' and fitz:
+            parts = ((content, f"-p{first}-{last}") for first, last, content in self.split_pdf(file_content))
+        elif size > SPLIT_THRESHOLD_BYTES and mime_type == DOCX_MIME_TYPE and Document:
+            parts = ((content, f"-part{number}") for number, content in self.split_docx(file_content))
+        else:
+            parts = iter(())
+        
+        try:
+            first_part = next(parts, None)
+            second_part = next(parts, None)
+        except Exception as e:
+            # Unreadable by the splitter: better to upload it whole than not at all
+            print(f"  Could not split {file_name}, uploading it whole: {e}")
+            first_part = second_part = None
+        if second_part is None:
+            # Nothing to split (or it fits in one part), upload the original file
+            file_content.seek(0)
+            yield file_content, mime_type, file_name
+            return
+        
+        # Keep the part suffix clear of the 60 character limit in sanitize_filename
+        base_name = os.path.splitext(file_name)[0][:48]
+        extension = _EXTENSION_MAP[mime_type]
+        print(f"  Splitting {file_name} into parts before upload")
+        for content, suffix in itertools.chain([first_part, second_part], parts):
+            yield content, mime_type, base_name + suffix + extension
+    
     def sanitize_filename(self, filename, mime_type):
-        extension_map = {
-            'application/vnd.openxmlformats-officedocument.wordprocessingml.document': '.docx',
-            'application/pdf': '.pdf',
-            'text/plain': '.txt'
-        }
         base_name, _ = os.path.splitext(filename)
-        sanitized = re.sub(r'[^\w\s\-_]', '', base_name).strip()[:60]
-        extension = extension_map.get(mime_type, '.bin')
+        sanitized = _SANITIZE_RE.sub('', base_name).strip()[:60]
+        extension = _EXTENSION_MAP.get(mime_type, '.bin')
         return (sanitized or "document") + extension
 
+    def _retry_after(self, response, attempt):
+        try:
+            return max(float(response.headers.get('Retry-After')), 0)
+        except (TypeError, ValueError):
+            # Header missing or an HTTP date: fall back to exponential backoff
+            return 0.5 * 2 ** attempt
+    
     def upload_to_voiceflow(self, file_content, file_name, mime_type):
         clean_filename = self.sanitize_filename(file_name, mime_type)
         print(f"  Uploading to Voiceflow: {clean_filename}")
         
         try:
             url = f"{self.voiceflow_base_url}/v1/knowledge-base/docs/upload"
-            headers = {'Authorization': self.voiceflow_api_key}
-            files = {'file': (clean_filename, file_content, mime_type)}
-            response = requests.post(url, headers=headers, files=files)
+            if isinstance(file_content, bytes):
+                file_content = io.BytesIO(file_content)
+            body = MultipartFileBody(file_content, clean_filename, mime_type)
+            headers = {'Authorization': self.voiceflow_api_key, 'Content-Type': body.content_type}
+            with self.upload_slots:
+                for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+                    self.upload_limiter.acquire()
+                    body.seek(0)
+                    response = self.session.post(url, headers=headers, data=body, timeout=(10, 120))
+                    if response.status_code != 429 or attempt == MAX_RATE_LIMIT_RETRIES:
+                        break
+                    
+                    delay = self._retry_after(response, attempt)
+                    print(f"  Rate limited by Voiceflow, retrying {clean_filename} in {delay:.1f}s")
+                    self.upload_limiter.pause(delay)
             
-            if response.status_code in [200, 201, 202]:
-                return {"status": "success", "message": f"Successfully uploaded: {clean_filename}"}
-            elif response.status_code == 409:
-                return {"status": "success", "message": f"File already exists: {clean_filename} (skipping)"}
-            else:
-                return {"status": "failure", "message": f"Failed to upload {clean_filename}: {response.status_code} - {response.text[:100]}"}
+            return self._upload_result(response, clean_filename)
                 
         except Exception as e:
             return {"status": "failure", "message": f"Error uploading {clean_filename}: {e}"}
     
+    def _upload_result(self, response, clean_filename):
+        if response.status_code in [200, 201, 202]:
+            try:
+                document_id = _json_loads(response.content).get('data', {}).get('documentID')
+            except (ValueError, AttributeError):
+                document_id = None
+            return {"status": "success", "message": f"Successfully uploaded: {clean_filename}", "document_id": document_id}
+        elif response.status_code == 409:
+            return {"status": "success", "message": f"File already exists: {clean_filename} (skipping)"}
+        else:
+            return {"status": "failure", "message": f"Failed to upload {clean_filename}: {response.status_code} - {self._error_message(response)}"}
+    
+    def _error_message(self, response):
+        try:
+            message = _json_loads(response.content).get('message')
+        except (ValueError, AttributeError):
+            message = None
+        return str(message or response.text)[:100]
+    
+    def _can_stream(self, file):
+        # Exports may fall back to plain text and large PDF/DOCX files are split, both need the whole file first
+        if not self.stream_uploads or file['mimeType'] in _EXPORT_MAP:
+            return False
+        splittable = file['mimeType'] in ('application/pdf', DOCX_MIME_TYPE)
+        return not (splittable and int(file.get('size', 0)) > SPLIT_THRESHOLD_BYTES)
+    
+    def stream_to_voiceflow(self, file):
+        """Download a file from Drive and upload it to Voiceflow at the same time, through an OS pipe."""
+        print(f"  Streaming: {file['name']}")
+        clean_filename = self.sanitize_filename(file['name'], file['mimeType'])
+        # Built here so the producer thread reuses this worker's Drive client, which is idle while we upload
+        request = self.drive_files.get_media(fileId=file['id'])
+        read_fd, write_fd = os.pipe()
+        download_errors = []
+        
+        def produce():
+            try:
+                with os.fdopen(write_fd, 'wb') as pipe_w:
+                    downloader = MediaIoBaseDownload(pipe_w, request, chunksize=DOWNLOAD_CHUNK_SIZE)
+                    done = False
+                    while not done:
+                        status, done = downloader.next_chunk()
+            except Exception as e:
+                download_errors.append(e)
+        
+        boundary = uuid.uuid4().hex
+        head, tail = _multipart_framing(boundary, clean_filename, file['mimeType'])
+        
+        def body(pipe_r):
+            yield head
+            yield from iter(lambda: pipe_r.read1(STREAM_CHUNK_SIZE), b'')
+            producer.join()
+            if download_errors:
+                # Abort mid-request so Voiceflow never sees a complete (truncated) file
+                raise download_errors[0]
+            yield tail
+        
+        producer = threading.Thread(target=produce, daemon=True)
+        try:
+            # Closing the read end on the way out unblocks the producer if the upload fails early
+            with os.fdopen(read_fd, 'rb') as pipe_r:
+                url = f"{self.voiceflow_base_url}/v1/knowledge-base/docs/upload"
+                headers = {
+                    'Authorization': self.voiceflow_api_key,
+                    'Content-Type': f'multipart/form-data; boundary={boundary}'
+                }
+                with self.upload_slots:
+                    self.upload_limiter.acquire()
+                    # Only start downloading once we may upload, so workers waiting for a slot hold no Drive data
+                    producer.start()
+                    response = self.stream_session.post(url, headers=headers, data=body(pipe_r), timeout=(10, 120))
+                if response.status_code == 429:
+                    self.upload_limiter.pause(self._retry_after(response, 0))
+                return self._upload_result(response, clean_filename)
+        except Exception as e:
+            # A broken pipe only means the upload stopped reading first, so the upload error is the real cause
+            if download_errors and not isinstance(download_errors[0], BrokenPipeError):
+                return {"status": "failure", "message": f"Download failed for {file['name']}: {download_errors[0]}"}
+            return {"status": "failure", "message": f"Error uploading {clean_filename}: {e}"}
+        finally:
+            if producer.ident is None:
+                # Never started, so the write end is still ours to close
+                os.close(write_fd)
+            else:
+                producer.join()
+    
+    def _process_one(self, file):
+        print(f"Processing: {file['name']}")
+        try:
+            if self._can_stream(file):
+                upload_result = self.stream_to_voiceflow(file)
+                document_ids = [upload_result['document_id']] if upload_result.get('document_id') else []
+                return file, upload_result['status'], upload_result['message'], document_ids
+            
+            file_content, upload_mime_type = self.download_file(file['id'], file['name'], file['mimeType'])
+            
+            if file_content is None:
+                print(f"  Download failed for {file['name']}. Skipping.")
+                return file, 'failure', "Download/Export Failed", []
+            
+            with file_content:
+                upload_results = [
+                    self.upload_to_voiceflow(content, name, mime_type)
+                    for content, mime_type, name in self._maybe_chunk(file_content, upload_mime_type, file['name'])
+                ]
+            
+            document_ids = [r['document_id'] for r in upload_results if r.get('document_id')]
+            if len(upload_results) == 1:
+                return file, upload_results[0]['status'], upload_results[0]['message'], document_ids
+            
+            failures = [r['message'] for r in upload_results if r['status'] != 'success']
+            if failures:
+                return file, 'failure', f"{len(failures)} of {len(upload_results)} parts failed: " + "; ".join(failures), document_ids
+            return file, 'success', f"Successfully uploaded {len(upload_results)} parts of {file['name']}", document_ids
+        except Exception as e:
+            return file, 'failure', f"Unexpected error processing {file['name']}: {e}", []
+    
+    def is_unchanged(self, file):
+        row = self.cache.execute("SELECT modifiedTime, md5 FROM uploaded WHERE file_id=?", (file['id'],)).fetchone()
+        # Google Workspace files have no md5Checksum, so for them only modifiedTime is compared
+        return row is not None and row == (file['modifiedTime'], file.get('md5Checksum'))
+    
+    def mark_uploaded(self, file, document_ids):
+        with self.cache:
+            self.cache.execute(
+                "INSERT OR REPLACE INTO uploaded (file_id, modifiedTime, md5, voiceflow_doc_id) VALUES (?, ?, ?, ?)",
+                (file['id'], file['modifiedTime'], file.get('md5Checksum'), ",".join(document_ids) or None)
+            )
+            self.cache.execute("DELETE FROM failed WHERE file_id=?", (file['id'],))
+    
+    def mark_failed(self, file):
+        with self.cache:
+            self.cache.execute("INSERT OR REPLACE INTO failed (file_id, file) VALUES (?, ?)", (file['id'], json.dumps(file)))
+    
+    def load_failed(self):
+        return {file_id: json.loads(file) for file_id, file in self.cache.execute("SELECT file_id, file FROM failed")}
+    
+    def forget_failed(self, file_ids):
+        with self.cache:
+            self.cache.executemany("DELETE FROM failed WHERE file_id=?", [(file_id,) for file_id in file_ids])
+    
     def sync_documents(self):
         print("=" * 50)
         print("Starting Google Drive to Voiceflow sync...")
         print("=" * 50)
         
-        files = self.get_drive_files()
-        if not files:
-            print("No files found to sync.")
-            return
+        state = self.load_state()
+        page_token = state.get('startPageToken')
         
-        print(f"Found {len(files)} files in Google Drive. Starting sync process...")
+        self.new_page_token = None
+        self.gone_ids = set()
+        self.full_scan = False
+        # Files that failed last run; the changes feed will not report them again unless they change
+        retry_files = self.load_failed()
         
         successful_files = []
         failed_files = []
+        skipped_count = 0
+        cancelled_count = 0
+        listing_complete = False
+        interrupted = False
+        # future -> Drive file, so results can still be recorded after an interrupt
+        futures = {}
+        recorded = set()
         
-        for i, file in enumerate(files, 1):
-            print(f"\n[{i}/{len(files)}] Processing: {file['name']}")
+        def record(future):
+            file, status, message, document_ids = future.result()
+            recorded.add(future)
+            print(f"[{len(recorded)}/{len(futures)}] {file['name']}: {message}")
             
-            file_content, upload_mime_type = self.download_file(file['id'], file['name'])
+            if status == 'success':
+                successful_files.append(file['name'])
+                self.mark_uploaded(file, document_ids)
+            else:
+                failed_files.append({"name": file['name'], "reason": message})
+                self.mark_failed(file)
+        
+        # Managed by hand rather than with "with" so that Ctrl+C cancels queued files instead of waiting for all of them
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            # Files are submitted as each listing page arrives, so downloads overlap with pagination
+            try:
+                for file in self.iter_files_to_sync(page_token):
+                    retry_files.pop(file['id'], None)
+                    if self.is_unchanged(file):
+                        skipped_count += 1
+                    else:
+                        futures[executor.submit(self._process_one, file)] = file
+                listing_complete = True
+            except Exception as e:
+                print(f"Error fetching Drive files: {e}")
             
-            if not file_content:
-                print(f"  Download failed for {file['name']}. Skipping.")
-                failed_files.append({"name": file['name'], "reason": "Download/Export Failed"})
-                continue
+            if self.full_scan and listing_complete:
+                # A complete scan saw every file in the folder, so the rest were deleted or moved out
+                self.forget_failed(retry_files)
+                retry_files = {}
+            else:
+                # Failed files that have since been deleted, trashed or moved out of the folder
+                gone = [file_id for file_id in retry_files if file_id in self.gone_ids]
+                for file_id in gone:
+                    del retry_files[file_id]
+                self.forget_failed(gone)
             
-            upload_result = self.upload_to_voiceflow(file_content, file['name'], upload_mime_type)
-            print(f"  {upload_result['message']}")
-
-            if upload_result['status'] == 'success':
-                successful_files.append(file['name'])
+            if retry_files:
+                print(f"Retrying {len(retry_files)} files that failed in a previous run.")
+                for file in retry_files.values():
+                    futures[executor.submit(self._process_one, file)] = file
+            
+            if not futures:
+                print("No new or modified files to sync.")
             else:
-                failed_files.append({"name": file['name'], "reason": upload_result['message']})
+                print(f"Found {len(futures)} new or modified files in Google Drive ({skipped_count} unchanged).")
             
-            time.sleep(1)  # Rate limiting
+            for future in as_completed(futures):
+                record(future)
+        except KeyboardInterrupt:
+            interrupted = True
+            print("\nInterrupted: cancelling queued files and waiting for in-flight ones to finish...")
+        finally:
+            executor.shutdown(wait=True, cancel_futures=interrupted)
+        
+        if interrupted:
+            for future, file in futures.items():
+                if future in recorded:
+                    continue
+                if future.cancelled():
+                    # Never started: queue it for the next run like a failure
+                    cancelled_count += 1
+                    self.mark_failed(file)
+                else:
+                    record(future)
+        
+        # Failed and cancelled files are retried from the cache, so the token only stays put when the listing was incomplete
+        if self.new_page_token and listing_complete:
+            page_token = self.new_page_token
+        state = {}
+        if page_token:
+            state['startPageToken'] = page_token
+        self.save_state(state)
         
         # Final Summary Report
         print("\n" + "=" * 50)
-        print("Sync Complete!")
+        print("Sync Interrupted!" if interrupted else "Sync Complete!")
         print("=" * 50)
-        print(f"Total files processed: {len(files)}")
+        print(f"Total files processed: {len(recorded)}")
+        print(f"Skipped (unchanged since last sync): {skipped_count}")
         print(f"Successful uploads: {len(successful_files)}")
         print(f"Failed uploads: {len(failed_files)}")
+        if interrupted:
+            print(f"Cancelled (will be retried next run): {cancelled_count}")
         
         if failed_files:
             print("\n--- FAILED FILES REPORT ---")